@@ -1,15 +1,28 @@
 #! /bin/python3 -B
 
 import argparse
+import atexit
+import concurrent.futures
+import functools
 import os
+import re
+import shlex
+import shutil
 import subprocess
 import uuid
 
+# matches package files (but not their signatures)
+_PKG_RE = re.compile(r"\.pkg\.(tar|txz|zst|xz|gz)(\.[^.]+)?$")
+
 class Dmakepkg:
     """
     Class implementing a package builder for Arch Linux using Docker.
     """
     __eDefaults = "--nosign --force --syncdeps --noconfirm"
+    __conf_cache = {}
+    __bash = None
+    __bash_end = b"\x00__DMAKEPKG_END__\x00"
+
     def __init__(self):
         self.pacman_conf = "/etc/pacman.conf"
         self.makepkg_conf = "/etc/makepkg.conf"
@@ -19,18 +32,72 @@ class Dmakepkg:
         self.command = None
         self.use_host_pacman = None
         self.parser = None
+        self.docker = shutil.which("docker") or "/usr/bin/docker"
+        self.gpg = shutil.which("gpg") or "/usr/bin/gpg"
 
-    # From https://stackoverflow.com/questions/17435056/read-bash-variables-into-a-python-script
+    @classmethod
+    def _run_in_bash(cls, cmd, *args):
+        """
+        Run the given command in a subshell of a long-running bash process with args
+        as positional parameters and return its output. The bash process is started
+        on first use and terminated when the script exits.
+        """
+        if cls.__bash is None or cls.__bash.poll() is not None:
+            cls.__bash = subprocess.Popen(["/bin/bash", "--noprofile", "--norc", "-s"],
+                                          stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                          bufsize=0)
+            atexit.register(cls.__bash.terminate)
+        arguments = " ".join(shlex.quote(arg) for arg in args)
+        cls.__bash.stdin.write(
+            f"(set -- {arguments}\n{cmd}\n) </dev/null; printf '\\0%s\\0' __DMAKEPKG_END__\n"
+            .encode("utf-8"))
+        output = b""
+        while not output.endswith(cls.__bash_end):
+            data = os.read(cls.__bash.stdout.fileno(), 65536)
+            if not data:
+                break
+            output += data
+        return output.removesuffix(cls.__bash_end).decode("utf-8")
+
+    # Based on https://stackoverflow.com/questions/17435056/read-bash-variables-into-a-python-script
     # Written by user Taejoon Byun
+    @classmethod
+    def _load(cls, script):
+        """
+        Source the given script in bash once and return a dict of all variables
+        it defines. Arrays are joined with spaces. The result is cached until the
+        modification time of the script changes.
+        """
+        try:
+            mtime = os.stat(script).st_mtime_ns
+        except OSError:
+            return {}
+        cached = cls.__conf_cache.get(script)
+        if cached and cached[0] == mtime:
+            return cached[1]
+        cmd = ('source "$1"; for v in $(compgen -v); do r="$v[*]"; '
+               'printf "%s\\0%s\\0" "$v" "${!r}"; done')
+        fields = cls._run_in_bash(cmd, script).split("\x00")
+        variables = {name: value.strip() for name, value in zip(fields[::2], fields[1::2])}
+        cls.__conf_cache[script] = (mtime, variables)
+        return variables
+
+    @classmethod
+    def get_vars(cls, script, *var_names):
+        """
+        Return the values of all the given variables of the script (bash/sh script)
+        as a list, in the order they were requested.
+        """
+        variables = cls._load(script)
+        return [variables.get(name, "") for name in var_names]
+
     @classmethod
     def get_var(cls, script, var_name):
         """
         Source the given script in bash and print out the value of the
         variable varName (bash/sh script)
         """
-        cmd = 'echo $(source "{}"; echo ${{{}[@]}})'.format(script, var_name)
-        process = subprocess.Popen(cmd, stdout=subprocess.PIPE, shell=True, executable='/bin/bash')
-        return process.stdout.readlines()[0].decode("utf-8").strip()
+        return cls._load(script).get(var_name, "")
 
     # From https://stackoverflow.com/questions/17435056/read-bash-variables-into-a-python-script
     # Written by user Taejoon Byun
@@ -39,29 +106,26 @@ class Dmakepkg:
         """
         Source the given script in bash and print out the value the function funcName returns
         """
-        cmd = 'echo $(source {}; echo $({}))'.format(script, func_name)
-        process = subprocess.Popen(cmd, stdout=subprocess.PIPE, shell=True, executable='/bin/bash')
-        return process.stdout.readlines()[0].decode("utf-8").strip()
+        return cls._run_in_bash(f'source "$1"; echo $({func_name})', script).strip()
 
-    def sign_packages(self):
+    def sign_packages(self, key=None):
         """
-        Sign all packages in the current working directory
+        Sign all packages in the current working directory with the given key
+        or the default key, if none is given
         """
-        args = ["/bin/gpg", "--batch", "--yes", "--detach-sign"]
-        key = self.get_var(self.makepkg_conf, "GPGKEY")
+        args = [self.gpg, "--batch", "--yes", "--detach-sign"]
         if key:
             args.extend(["-u", key])
-        files = []
-        for (_, _, filenames) in os.walk(os.getcwd()):
-            files.extend(filenames)
-            break
-
-        for item in files:
-            if ".pkg." in item and not item.endswith("sig"):
-                pkg_and_not_sigs = []
-                pkg_and_not_sigs.extend(args)
-                pkg_and_not_sigs.append(item)
-                subprocess.run(pkg_and_not_sigs)
+        with os.scandir(os.getcwd()) as entries:
+            pkgs = [entry.name for entry in entries
+                    if _PKG_RE.search(entry.name) and not entry.name.endswith(".sig")
+                    and entry.is_file()]
+        if not pkgs:
+            return
+        # gpg runs as a separate process, so threads are enough to sign in parallel
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=min(len(pkgs), os.cpu_count() or 4)) as executor:
+            list(executor.map(lambda pkg: subprocess.run(args + [pkg], check=False), pkgs))
 
     # this function finds all possible arguments to the docker command line we could need
     # and builds them.
@@ -72,62 +136,75 @@ class Dmakepkg:
         """
         parameters = ["-v", "/etc/makepkg.conf:/etc/makepkg.conf:ro"]
 
-        for i in ["SRCDEST", "PKGDEST", "SRCPKGDEST", "LOGDEST"]:
-            value = self.get_var(self.makepkg_conf, i)
+        names = ["SRCDEST", "PKGDEST", "SRCPKGDEST", "LOGDEST"]
+        for i, value in zip(names, self.get_vars(self.makepkg_conf, *names)):
             if value != "":
-                parameters.extend(["-v", "{}:{}".format(i, value)])
+                parameters.extend(["-v", f"{i}:{value}"])
         return parameters
 
-    def main(self):
+    @classmethod
+    @functools.lru_cache(maxsize=1)
+    def _build_parser(cls):
         """
-        Main function for running this python script. Implements the argument parser,
-        logic to start the docker container and signing of the built packages.
+        Build the argument parser. It is only built once and reused afterwards.
         """
-        self.parser = argparse.ArgumentParser(prog="dmakepkg")
-        self.parser.add_argument(
+        parser = argparse.ArgumentParser(prog="dmakepkg")
+        parser.add_argument(
             '-x',
             action='store_false',
             help="Do not use host system's /etc/pacman.conf"
             )
-        self.parser.add_argument(
+        parser.add_argument(
             '-X',
             action='store_false',
             help="Do not use host system's /etc/pacman.d/mirrorlist"
             )
-        self.parser.add_argument(
+        parser.add_argument(
             '-y',
             action='store_false',
             help="Never use pump mode, even if pump mode capable servers are configured")
-        self.parser.add_argument(
+        parser.add_argument(
             '-Y',
             action='store_true',
             help="Use the host system's package cache (/var/cache/pacman/pkg)"
             )
-        self.parser.add_argument(
+        parser.add_argument(
             '-z',
             action='store_true',
             help="Do not automatically download missing PGP keys",
             )
-        self.parser.add_argument(
+        parser.add_argument(
             '-Z',
             action='store_true',
             help="Do not copy the source files. Build in the directory directly."
             )
-        self.parser.add_argument(
+        parser.add_argument(
             '-e',
             nargs='?',
             help="Executes the argument as a command in the container after copying the"
                  "package source")
 
-        self.parser.add_argument(
+        parser.add_argument(
             'rest',
             nargs=argparse.REMAINDER,
             help="The arguments that are passed to the call to pacman in its executions in the"
                  "container. They default to \"--nosign --force --syncdeps --noconfirm\".")
+        return parser
 
+    def main(self):
+        """
+        Main function for running this python script. Implements the argument parser,
+        logic to start the docker container and signing of the built packages.
+        """
+        cwd = os.getcwd()
+        uid = str(os.geteuid())
+        gid = str(os.getegid())
+        name = f"dmakepkg_{uuid.uuid4()}"
+
+        self.parser = self._build_parser()
         namespace, rest = self.parser.parse_known_args()
 
-        parameters = ["--name", "dmakepkg_{}".format(uuid.uuid4())]
+        parameters = ["--name", name]
 
         # pacman.conf is not a bash file, so this doesn't work.
         # local_cache_dir = self.get_var(self.pacmanConf, "CacheDir")
@@ -144,9 +221,10 @@ class Dmakepkg:
             parameters.extend(["-v", "/etc/pacman.d/mirrorlist:/etc/pacman.d/mirrorlist:ro"])
 
         if namespace.Y:
-            parameters.extend(["-v",
-                 "{local_cache_dir}:{local_cache_dir}:ro".format(
-                     local_cache_dir=local_cache_dir)])
+            parameters.extend(["-v", f"{local_cache_dir}:{local_cache_dir}:ro"])
+
+        if "DMAKEPKG_COPY_JOBS" in os.environ:
+            parameters.extend(["-e", f"DMAKEPKG_COPY_JOBS={os.environ['DMAKEPKG_COPY_JOBS']}"])
 
         self.use_pump_mode = namespace.y
         self.command = namespace.e
@@ -158,7 +236,7 @@ class Dmakepkg:
         # set object attributes
         # self.hostPacmanConf = namespace.
         # create first part
-        complete_cmd_line = ["/bin/docker",
+        complete_cmd_line = [self.docker,
                              "run",
                              "--init",
                              "--rm",
@@ -166,7 +244,7 @@ class Dmakepkg:
                              "--cpu-shares=128",
                              "--pids-limit=-1",
                              "-v",
-                             "{}:/src".format(os.getcwd())]
+                             f"{cwd}:/src"]
 
         complete_cmd_line.extend(parameters)
         complete_cmd_line.append("makepkg")
@@ -178,19 +256,20 @@ class Dmakepkg:
         if namespace.Z:
             complete_cmd_line.append("-Z")
 
-        complete_cmd_line.extend(["-u", str(os.geteuid()), "-g", str(os.getegid())])
+        complete_cmd_line.extend(["-u", uid, "-g", gid])
         if self.command:
             complete_cmd_line.extend(["-e", self.command])
         complete_cmd_line.extend(namespace.rest)
         complete_cmd_line.extend(rest)
 
-        docker_process = subprocess.Popen(complete_cmd_line)
+        docker_process = subprocess.Popen(complete_cmd_line, close_fds=False)
         docker_process.wait()
 
-        for i in self.get_var(self.makepkg_conf, "BUILDENV").split():
+        build_env, key = self.get_vars(self.makepkg_conf, "BUILDENV", "GPGKEY")
+        for i in build_env.split():
             if "sign" in i:
                 if not i.startswith("!"):
-                    self.sign_packages()
+                    self.sign_packages(key)
 
 if __name__ == '__main__':
     DM = Dmakepkg()
@@ -1,8 +1,9 @@
 #! /bin/python3 -B
 
-import atexit
 import ipaddress
 import os
+import shutil
+import signal
 import subprocess
 import sys
 
@@ -36,6 +37,10 @@ class DmakepkgBuilder:
         self.cache = True
         self.darkhttpd_process = None
         self.docker_build_process = None
+        self.docker = shutil.which("docker") or "/usr/bin/docker"
+        self.darkhttpd = shutil.which("darkhttpd") or "/usr/bin/darkhttpd"
+        self.iptables = shutil.which("iptables") or "/usr/bin/iptables"
+        self.ip6tables = shutil.which("ip6tables") or "/usr/bin/ip6tables"
 
     @classmethod
     def get_docker0_address(cls):
@@ -44,7 +49,7 @@ class DmakepkgBuilder:
         """
         try:
             addresses = netifaces.ifaddresses('docker0')
-        except:
+        except (ValueError, KeyError):
             eprint("No docker0 interface exists. Looks like you don't run docker?")
             # we could actually theoretically use an IP from any interface, but I want
             # to make sure to not make any holes into existing rule sets that protect
@@ -62,32 +67,37 @@ class DmakepkgBuilder:
                 elif family == netifaces.AF_INET6:
                     for address_dict in address_list:
                         ipv6_address = ipaddress.ip_address(address_dict["addr"])
-                        if not ipv6_address.is_link_local():
-                            return ipaddress.ip_address(address_dict["addr"])
+                        if not ipv6_address.is_link_local:
+                            return ipv6_address
             eprint("No suitable address found for the local cache. " +
                    "Therefore the local cache is disabled.")
             return None
 
-    @classmethod
-    def start_docker_build(cls):
+    def start_docker_build(self):
         """
         Start docker build
         """
-        args = ["/bin/docker", "build", "--pull", "--no-cache", "--tag=makepkg", os.path.dirname(
+        args = [self.docker, "build", "--pull", "--no-cache", "--tag=makepkg", os.path.dirname(
             os.path.realpath(__file__))]
-        docker_id=None
-        process=None
+        docker_id = None
         try:
-            process=subprocess.run(args, capture_output=True)
-        except:
-            pass
-        if process:
-            if process.returncode:
-                docker_id=process.stdout.decode("utf-8")
-                try:
-                    subprocess.run(["/bin/docker", "container", "rm", docker_id])
-                except:
-                    pass
+            process = subprocess.Popen(args, stdout=subprocess.PIPE)
+        except OSError as e:
+            eprint(e)
+            return 1
+        # stream the build log and remember the container of the step that is running
+        for line in process.stdout:
+            sys.stdout.buffer.write(line)
+            sys.stdout.buffer.flush()
+            if line.startswith(b" ---> Running in "):
+                docker_id = line.split()[-1].decode("utf-8")
+        process.wait()
+        if process.returncode and docker_id:
+            try:
+                subprocess.run([self.docker, "container", "rm", docker_id])
+            except OSError:
+                pass
+        return process.returncode
 
     def pacman_cache_exists(self):
         """
@@ -95,12 +105,19 @@ class DmakepkgBuilder:
         """
         return os.path.exists(self.pacman_cache_dir)
 
+    def pacman_cache_empty(self):
+        """
+        Check if the pacman cache directory contains no packages
+        """
+        with os.scandir(self.pacman_cache_dir) as entries:
+            return not any(True for _ in entries)
+
     def create_dockerfile(self):
         """
         Generate the Dockerfile
         """
         if self.cache:
-            complete = self.head + (
+            middle = (
                 "\nRUN /bin/bash -c 'cat <(echo Server = "
                 "http://{}:{}) /etc/pacman.d/mirrorlist > foobar && mv foobar "
                 "/etc/pacman.d/mirrorlist && pacman -Syuq --noconfirm --needed "
@@ -109,25 +126,25 @@ class DmakepkgBuilder:
                 "cp /etc/pacman.d/mirrorlist foo && tail -n +2 foo > "
                 "/etc/pacman.d/mirrorlist'\n").format(
                     self.pacman_cache_ip.compressed,
-                    self.pacman_cache_port) + self.tail
+                    self.pacman_cache_port)
         else:
-            complete = self.head + (
+            middle = (
                 """\nRUN pacman -Syuq --noconfirm "
                 "--needed procps-ng  gcc base-devel distcc ccache python git mercurial "
                 "bzr subversion openssh && rm -rf /var/cache/pacman/pkg/*\n"
-                "COPY pump /usr/bin/pump\n""") + self.tail
+                "COPY pump /usr/bin/pump\n""")
         # write file
         script_location = os.path.realpath(__file__)
 
         with open(os.path.join(os.path.dirname(script_location), "Dockerfile"), "w") as docker_file:
-            docker_file.write(complete)
+            docker_file.writelines([self.head, middle, self.tail])
 
     def start_local_cache(self):
         """
         Start the pacman http cache
         """
         # runs darkhttpd
-        args = ["/usr/bin/darkhttpd", self.pacman_cache_dir, "--port", self.pacman_cache_port]
+        args = [self.darkhttpd, self.pacman_cache_dir, "--port", self.pacman_cache_port]
         self.darkhttpd_process = subprocess.Popen(args)
 
     def stop_local_cache(self):
@@ -136,29 +153,27 @@ class DmakepkgBuilder:
         """
         self.darkhttpd_process.terminate()
 
+    def _iptables_rule(self, operation):
+        """
+        Build the iptables command line for the pacman http cache rule with the given
+        operation (-I or -D)
+        """
+        comm = self.ip6tables if self.pacman_cache_ip.version == 6 else self.iptables
+        return [comm, "-w", "5", "-W", "2000", operation, "INPUT", "-p", "tcp", "--dport",
+                self.pacman_cache_port, "-i", "docker0", "-d", self.pacman_cache_ip.compressed,
+                "-j", "ACCEPT"]
+
     def insert_iptables_rules(self):
         """
         Install the iptables rule for the pacman http cache
         """
-        comm = {
-            4 : "/bin/iptables",
-            6 : "/bin/ip6tables"
-        }[self.pacman_cache_ip.version]
-        args = "{} -w 5 -W 2000 -I INPUT -p tcp --dport 8990 -i docker0 -d {} -j ACCEPT".format(
-            comm, self.pacman_cache_ip.compressed).split()
-        subprocess.run(args)
+        subprocess.run(self._iptables_rule("-I"))
 
     def delete_iptables_rules(self):
         """
         Remove the iptables rule for the pacman http cache
         """
-        comm = {
-            4 : "/bin/iptables",
-            6 : "/bin/ip6tables"
-        }[self.pacman_cache_ip.version]
-        args = "{} -w 5 -W 2000 -D INPUT -p tcp --dport 8990 -i docker0 -d {} -j ACCEPT".format(
-            comm, self.pacman_cache_ip.compressed).split()
-        subprocess.run(args)
+        subprocess.run(self._iptables_rule("-D"))
 
     def main(self):
         """
@@ -167,25 +182,28 @@ class DmakepkgBuilder:
         # check the docker0 address
         ip_address = self.get_docker0_address()
 
-        if not ip_address or not self.pacman_cache_exists():
+        if not ip_address or not self.pacman_cache_exists() or self.pacman_cache_empty():
             self.cache = False
         self.pacman_cache_ip = ip_address
 
         # create and write Dockerfile
         self.create_dockerfile()
 
-        # start darkhttpd
-        self.start_local_cache()
-        # make sure it gets stopped if the script exits
-        atexit.register(self.stop_local_cache)
-
-        # insert iptables rule
-        self.insert_iptables_rules()
-
-        # make sure it gets cleaned up if the script exits
-        atexit.register(self.delete_iptables_rules)
+        # make sure Ctrl-C still runs the cleanup below
+        signal.signal(signal.SIGINT, lambda *_: sys.exit(130))
 
-        sys.exit(self.start_docker_build())
+        if self.cache:
+            # start darkhttpd
+            self.start_local_cache()
+        try:
+            if self.cache:
+                # insert iptables rule
+                self.insert_iptables_rules()
+            sys.exit(self.start_docker_build())
+        finally:
+            if self.cache:
+                self.delete_iptables_rules()
+                self.stop_local_cache()
 
 if __name__ == "__main__":
     BUILDER = DmakepkgBuilder()
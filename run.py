@@ -1,13 +1,17 @@
 #! /bin/python3 -B
 
 import argparse
-import glob
+import concurrent.futures
+import errno
+import functools
 import os
 import os.path
 import pwd
+import re
 import subprocess
 import shutil
 import shlex
+import stat
 import sys
 
 def eprint(*args, **kwargs):
@@ -16,13 +20,77 @@ def eprint(*args, **kwargs):
     """
     print(*args, file=sys.stderr, **kwargs)
 
+# arguments for makepkg if none were given
+_REST_DEFAULTS = ("--nosign", "--force", "--syncdeps", "--noconfirm")
+
+# simple NAME=value assignments in a bash script, optionally quoted. Arrays are skipped.
+_ASSIGNMENT_RE = re.compile(r"""^(\w+)=(?!\()(?:"([^"]*)"|'([^']*)'|([^\s#]*))""", re.MULTILINE)
+
+@functools.lru_cache(maxsize=None)
+def _parse_makepkg_conf(path, mtime):
+    """
+    Parse the simple variable assignments in the makepkg.conf found in path.
+    mtime is only used as part of the cache key, so changed files are parsed again.
+    """
+    with open(path) as file:
+        content = file.read()
+    return {match.group(1): match.group(2) or match.group(3) or match.group(4) or ""
+            for match in _ASSIGNMENT_RE.finditer(content)}
+
+def _copy_file_contents(src_fd, dst_fd):
+    """
+    Copy everything from src_fd to dst_fd in the kernel if possible.
+    Tries copy_file_range first, then sendfile and falls back to a read/write loop.
+    """
+    try:
+        while os.copy_file_range(src_fd, dst_fd, 2**31 - 1):
+            pass
+        return
+    except OSError as e:
+        if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP):
+            raise
+    try:
+        while os.sendfile(dst_fd, src_fd, None, 1 << 30):
+            pass
+        return
+    except OSError as e:
+        if e.errno not in (errno.ENOSYS, errno.EINVAL):
+            raise
+    buffer = bytearray(1 << 20)
+    view = memoryview(buffer)
+    while True:
+        length = os.readv(src_fd, [buffer])
+        if not length:
+            break
+        written = 0
+        while written < length:
+            written += os.writev(dst_fd, [view[written:length]])
+
+def _copy_file(src, dst, uid=-1, gid=-1):
+    """
+    Copy the file src to dst and preserve its mode and timestamps.
+    The copy is owned by uid and gid, unless they are -1.
+    """
+    src_fd = os.open(src, os.O_RDONLY)
+    try:
+        stat_result = os.fstat(src_fd)
+        dst_fd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        try:
+            _copy_file_contents(src_fd, dst_fd)
+            if uid != -1 or gid != -1:
+                os.fchown(dst_fd, uid, gid)
+            os.fchmod(dst_fd, stat.S_IMODE(stat_result.st_mode))
+            os.utime(dst_fd, ns=(stat_result.st_atime_ns, stat_result.st_mtime_ns))
+        finally:
+            os.close(dst_fd)
+    finally:
+        os.close(src_fd)
+
 class DmakepkgContainer:
     """
     Class implementing a package builder for Arch Linux using Docker.
     This is the file running inside the container.
     """
-    __restDefaults = "--nosign --force --syncdeps --noconfirm"
-
     def __init__(self):
         self.parser = None
         self.rest = None
@@ -34,40 +102,82 @@ class DmakepkgContainer:
         self.download_keys = None
 
     @classmethod
-    def copy_tree(cls, src, dst, symlinks=False, ignore=None):
+    def copy_tree(cls, src, dst, symlinks=False, ignore=None, uid=-1, gid=-1):
         """
-        Copy the directory tree from src to dst
-        From https://stackoverflow.com/questions/1868714
-        Written by user atzz
+        Copy the contents of the directory src into the directory dst. Directories
+        that already exist are reused, like shutil.copytree with dirs_exist_ok.
+        Symbolic links are copied as links if symlinks is set and followed otherwise.
+        ignore works like the ignore argument of shutil.copytree.
+        Everything that is created is owned by uid and gid, unless they are -1.
+        Files are copied in parallel by DMAKEPKG_COPY_JOBS threads. Special files such as
+        FIFOs and devices are skipped.
         """
-        for item in os.listdir(src):
-            source_directory = os.path.join(src, item)
-            destination_directory = os.path.join(dst, item)
-            if os.path.isdir(source_directory):
-                shutil.copytree(source_directory, destination_directory, symlinks, ignore)
-            else:
-                shutil.copy2(source_directory, destination_directory)
+        change_owner = uid != -1 or gid != -1
+        jobs = min(32, (os.cpu_count() or 1) * 4)
+        if "DMAKEPKG_COPY_JOBS" in os.environ:
+            try:
+                jobs = int(os.environ["DMAKEPKG_COPY_JOBS"])
+            except ValueError:
+                eprint(f"Invalid DMAKEPKG_COPY_JOBS value {os.environ['DMAKEPKG_COPY_JOBS']!r}, "
+                       f"using {jobs} jobs.")
+        directories = []
+        os.makedirs(dst, exist_ok=True)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(jobs, 1)) as executor:
+            futures = []
+            pending = [(src, dst)]
+            while pending:
+                source_directory, destination_directory = pending.pop()
+                with os.scandir(source_directory) as iterator:
+                    entries = list(iterator)
+                ignored = ignore(source_directory, [entry.name for entry in entries]) \
+                    if ignore else ()
+                for entry in entries:
+                    if entry.name in ignored:
+                        continue
+                    destination = os.path.join(destination_directory, entry.name)
+                    if symlinks and entry.is_symlink():
+                        os.symlink(os.readlink(entry.path), destination)
+                        if change_owner:
+                            os.chown(destination, uid, gid, follow_symlinks=False)
+                    elif entry.is_dir():
+                        os.makedirs(destination, exist_ok=True)
+                        if change_owner:
+                            os.chown(destination, uid, gid)
+                        pending.append((entry.path, destination))
+                        directories.append((entry.path, destination))
+                    elif entry.is_file():
+                        futures.append(executor.submit(
+                            _copy_file, entry.path, destination, uid, gid))
+                    else:
+                        # opening FIFOs or devices would block or copy endlessly
+                        eprint(f"Skipping {entry.path}: not a regular file")
+            for future in futures:
+                future.result()
+        # copy the directory metadata last, copying the files changes the timestamps
+        for source_directory, destination_directory in reversed(directories):
+            shutil.copystat(source_directory, destination_directory)
 
     @classmethod
     def change_user_or_gid(cls, uid, gid, path):
         """
         Change all owner UIDs and GIDs of the files in the path to the given ones
         to not change either gid or uid, set that value to -1.
-        From https://stackoverflow.com/questions/2853723
-        Written by user "too much php"
         """
         os.chown(path, uid, gid)
-        for root, dirs, files in os.walk(path):
-            for momo in dirs:
-                try:
-                    os.chown(os.path.join(root, momo), uid, gid)
-                except Exception as e:
-                    eprint(e)
-            for momo in files:
-                try:
-                    os.chown(os.path.join(root, momo), uid, gid)
-                except Exception as e:
-                    eprint(e)
+        pending = [path]
+        while pending:
+            with os.scandir(pending.pop()) as entries:
+                for entry in entries:
+                    try:
+                        # skip the chown if it would not change anything
+                        stat_result = entry.stat(follow_symlinks=False)
+                        if (uid != -1 and stat_result.st_uid != uid) or \
+                                (gid != -1 and stat_result.st_gid != gid):
+                            os.chown(entry.path, uid, gid, follow_symlinks=False)
+                    except OSError as e:
+                        eprint(e)
+                    if entry.is_dir(follow_symlinks=False):
+                        pending.append(entry.path)
 
     # From https://www.tutorialspoint.com/How-to-change-the-permission-of-a-directory-using-Python
     # Written by Rajendra Dharmkar
@@ -77,20 +187,22 @@ class DmakepkgContainer:
         Change the permissions of all files and directories in the given path to the given mode
         """
         os.chmod(path, mode)
-        for root, dirs, files in os.walk(path, topdown=False):
-            for directory in [os.path.join(root, d) for d in dirs]:
-                os.chmod(directory, mode)
-            for file in [os.path.join(root, f) for f in files]:
-                os.chmod(file, mode)
+        for _, dirs, files, root_fd in os.fwalk(path, topdown=False):
+            for name in dirs:
+                os.chmod(name, mode, dir_fd=root_fd)
+            for name in files:
+                os.chmod(name, mode, dir_fd=root_fd)
 
     @classmethod
     def append_to_file(cls, path, content):
         """
         Append the given content to the file found in the given path
         """
-        with open(path, "a+") as file:
-            file.seek(0, 2)
-            file.write(content)
+        fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+        try:
+            os.write(fd, content.encode("utf-8"))
+        finally:
+            os.close(fd)
 
     # From https://stackoverflow.com/questions/17435056/read-bash-variables-into-a-python-script
     # Written by user Taejoon Byun
@@ -100,9 +212,9 @@ class DmakepkgContainer:
         Source the given script in bash and print out the value of the
         variable varName (bash/sh script)
         """
-        cmd = 'echo $(source "{}"; echo ${{{}[@]}})'.format(script, var_name)
-        process = subprocess.Popen(cmd, stdout=subprocess.PIPE, shell=True, executable='/bin/bash')
-        return process.stdout.readlines()[0].decode("utf-8").strip()
+        cmd = f'source "$1"; printf "%s" "${{{var_name}[*]}}"'
+        return subprocess.run(["/bin/bash", "-c", cmd, "_", script], capture_output=True,
+                              text=True, check=False).stdout.strip()
 
     # From https://stackoverflow.com/questions/17435056/read-bash-variables-into-a-python-script
     # Written by user Taejoon Byun
@@ -111,15 +223,26 @@ class DmakepkgContainer:
         """
         Source the given script in bash and print out the value the function funcName returns
         """
-        cmd = 'echo $(source "{}"; echo $({}))'.format(script, func_name)
-        process = subprocess.Popen(cmd, stdout=subprocess.PIPE, shell=True, executable='/bin/bash')
-        return process.stdout.readlines()[0].decode("utf-8").strip()
+        cmd = f'source "$1"; echo $({func_name})'
+        return subprocess.run(["/bin/bash", "-c", cmd, "_", script], capture_output=True,
+                              text=True, check=False).stdout.strip()
+
+    @classmethod
+    def get_conf_var(cls, var_name, path="/etc/makepkg.conf"):
+        """
+        Return the value of the plain variable varName of the makepkg.conf without
+        running bash. Parsed files are cached until they are modified.
+        """
+        try:
+            return _parse_makepkg_conf(path, os.stat(path).st_mtime_ns).get(var_name, "")
+        except OSError:
+            return ""
 
     def check_for_pump_mode(self):
         """
         Check if pump mode is enabled for any of the DISTCC_HOSTS in /etc/makepkg.conf
         """
-        if ",cpp" in self.get_var("/etc/makepkg.conf", "DISTCC_HOSTS") and self.use_pump_mode:
+        if ",cpp" in self.get_conf_var("DISTCC_HOSTS") and self.use_pump_mode:
             return True
         return False
 
@@ -128,6 +251,15 @@ class DmakepkgContainer:
         Main function for running this python script. Implements the argument parser, logic
         to build a complete package and copying of the build packages to the shared directory.
         """
+        # a single lstat tells both whether the PKGBUILD exists and whether it is a symlink
+        try:
+            stat_result = os.lstat("/src/PKGBUILD")
+        except OSError:
+            stat_result = None
+        if not stat_result or not stat.S_ISREG(stat_result.st_mode):
+            eprint("No PKGBUILD file found! Aborting.")
+            sys.exit(1)
+
         self.parser = argparse.ArgumentParser(prog="dmakepkgContainer")
         self.parser.add_argument(
             '-e',
@@ -161,89 +293,71 @@ class DmakepkgContainer:
 
         namespace, self.rest = self.parser.parse_known_args()
 
-        if not os.path.isfile("/src/PKGBUILD") or os.path.islink("/src/PKGBUILD"):
-            eprint("No PKGBUILD file found! Aborting.")
-            sys.exit(1)
-
         self.command = namespace.e
         self.group = int(namespace.g)
         self.run_pacman_syu = namespace.p
         self.user = int(namespace.u)
         self.use_pump_mode = namespace.y
         self.download_keys = namespace.z
-        build_user_uid = None
         if namespace.Z:
-            stat_result = os.stat("/src/PKGBUILD")
-            subprocess.run(["groupadd", "-g", str(stat_result.st_gid), "build-user"])
-            subprocess.run(["useradd", "-m", "-d", "/build", "-s", "/bin/bash", "-u", str(stat_result.st_uid), "-g", str(stat_result.st_gid), "build-user"])
-            self.change_user_or_gid(stat_result.st_uid, stat_result.st_gid, "/build")
-            build_user_uid = stat_result.st_gid
+            subprocess.run(["groupadd", "-g", str(stat_result.st_gid), "build-user"],
+                           stdin=subprocess.DEVNULL, close_fds=False)
+            subprocess.run(["useradd", "-m", "-d", "/build", "-s", "/bin/bash", "-u", str(stat_result.st_uid), "-g", str(stat_result.st_gid), "build-user"],
+                           stdin=subprocess.DEVNULL, close_fds=False)
+            build_user_uid = stat_result.st_uid
+            build_user_gid = stat_result.st_gid
+            self.change_user_or_gid(build_user_uid, build_user_gid, "/build")
             os.chdir("/src")
         else:
-            subprocess.run(["useradd", "-m", "-d", "/build", "-s", "/bin/bash", "build-user"])
-            build_user_uid = pwd.getpwnam("build-user").pw_uid
-            build_user_gid = pwd.getpwnam("build-user").pw_gid
-            self.copy_tree("/src/", "/build")
-            self.change_user_or_gid(build_user_uid, build_user_gid, "/build")
+            subprocess.run(["useradd", "-m", "-d", "/build", "-s", "/bin/bash", "build-user"],
+                           stdin=subprocess.DEVNULL, close_fds=False)
+            build_user_pw = pwd.getpwnam("build-user")
+            build_user_uid = build_user_pw.pw_uid
+            build_user_gid = build_user_pw.pw_gid
+            os.chown("/build", build_user_uid, build_user_gid)
+            self.copy_tree("/src/", "/build", uid=build_user_uid, gid=build_user_gid)
 
-        if self.run_pacman_syu:
-            arguments = "pacman --noconfirm -Syu".split()
-            pacman_process = subprocess.Popen(arguments)
-            pacman_process.wait()
-        else:
-            arguments = "pacman --noconfirm -Sy".split()
-            pacman_process = subprocess.Popen(arguments)
-            pacman_process.wait()
-        flags = None
+        subprocess.run(["pacman", "--noconfirm", "-Syu" if self.run_pacman_syu else "-Sy"],
+                       check=False, close_fds=False)
         built_packages = []
 
         if not self.rest:
-            flags = self.__restDefaults.split()
+            flags = list(_REST_DEFAULTS)
         else:
-            # translate list object to space seperated arguments
             flags = self.rest
 
         if self.download_keys:
             gnupg = os.path.expanduser("~build-user/.gnupg")
             os.makedirs(gnupg, mode=0o700, exist_ok=True)
-            self.change_user_or_gid(build_user_uid, pwd.getpwnam("build-user").pw_gid, "/build")
             self.append_to_file(gnupg + "/gpg.conf", "\nauto-key-retrieve\n")
             self.change_permissions_recursively(gnupg, 0o700)
-            self.change_permissions_recursively(gnupg + "/gpg.conf", 0o600)
-            self.change_user_or_gid(pwd.getpwnam("build-user").pw_uid, pwd.getpwnam("build-user").pw_gid, "/build")
+            os.chmod(gnupg + "/gpg.conf", 0o600)
+            os.chown(gnupg, build_user_uid, build_user_gid)
+            os.chown(gnupg + "/gpg.conf", build_user_uid, build_user_gid)
 
         # if a command is specified in -e, then run it
         if self.command:
             args = shlex.split(self.command)
-            subprocess.run(args)
+            subprocess.run(args, close_fds=False)
 
-        # su resets PATH, so distcc doesn't find the distcc directory
+        # makepkg runs as build-user in its home directory unless building in /src directly
+        if not namespace.Z:
+            os.chdir("/build")
+        environment = dict(os.environ, HOME="/build", SHELL="/bin/bash", USER="build-user",
+                           LOGNAME="build-user")
         if self.check_for_pump_mode():
-            "pump makepkg {}\n".format(" ".join(flags))
-            arguments = ['su', '-c', 'DISTCC_HOSTS="{}" DISTCC_LOCATION={} pump makepkg {}'.format(
-                self.get_var("/etc/makepkg.conf", "DISTCC_HOSTS"),
-                "/usr/bin", " ".join(flags)), '-s', '/bin/bash', 'build-user']
-            makepkg_process = subprocess.run(arguments)
-
-            # while makepkgProcess.poll() == None:
-            #   outs, errs = makepkgProcess.communicate(input="")
-            #   if outs:
-            #       print(outs)
-            #   if errs:
-            #       eprint(errs)
+            # runuser may reset PATH, so distcc doesn't find the distcc directory
+            environment["DISTCC_HOSTS"] = self.get_conf_var("DISTCC_HOSTS")
+            environment["DISTCC_LOCATION"] = "/usr/bin"
+            arguments = ['runuser', '-u', 'build-user', '--', 'pump', 'makepkg', *flags]
+            makepkg_process = subprocess.run(arguments, env=environment, close_fds=False)
         else:
-            arguments = ['su', '-c',
-                         'makepkg {}'.format(" ".join(flags)),
-                         '-s',
-                         '/bin/bash',
-                         '-l', 'build-user']
-            makepkg_process = subprocess.Popen(arguments)
-            while makepkg_process.poll() is None:
-                outs, errs = makepkg_process.communicate(input="")
-                if outs:
-                    print(outs)
-                if errs:
-                    eprint(errs)
+            # use a login shell, so the PATH set up by /etc/profile.d is available.
+            # The flags are passed as positional parameters, not joined into the command.
+            arguments = ['runuser', '-u', 'build-user', '--', '/bin/bash', '-lc',
+                         'exec makepkg "$@"', 'makepkg', *flags]
+            makepkg_process = subprocess.run(arguments, check=False, env=environment,
+                                             close_fds=False)
 
         if self.user and not self.group:
             self.change_user_or_gid(self.user, self.group, "/build")
@@ -251,13 +365,15 @@ class DmakepkgContainer:
             self.change_user_or_gid(self.user, -1, "/build")
 
         # copy any packages
-        # use globbing to get all packages
-        for item in glob.iglob("/build/*pkg.tar*"):
-            try:
-                shutil.copy(item, "/src")
-                built_packages.append(item)
-            except Exception as e:
-                eprint(e)
+        with os.scandir("/build") as entries:
+            for entry in entries:
+                if "pkg.tar" not in entry.name or not entry.is_file(follow_symlinks=False):
+                    continue
+                try:
+                    _copy_file(entry.path, "/src/" + entry.name)
+                    built_packages.append(entry.path)
+                except Exception as e:
+                    eprint(e)
 
         if not built_packages:
             eprint("No packages were built!")